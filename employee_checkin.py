@@ -1,161 +1,758 @@
 import io
+import logging
+import itertools
+import lz4.frame
+import mmap
+import numpy as np
 import streamlit as st
 import qrcode
-import json
+import msgpack
+import orjson
+import pandas as pd
+import queue
+import threading
+import os
 import secrets
 import base64
+import hashlib
+import hmac
+import time
+import googleapiclient.http
 from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2 import service_account
 from datetime import datetime
-import onetimepass
-import urllib
+import urllib.parse
+
+logger = logging.getLogger(__name__)
 
 # --- CONFIGURATION ---
 EMPLOYEE_DATA_FILE = "employee_data.json"
-TIME_ENTRIES_FILE = "time_entries.json"
+TIME_ENTRIES_FILE = "time_entries.jsonl"  # Append-only log, one [employeeId, epoch, type] entry per line
+CHECKPOINT_DIR = "time_entries.checkpoint"  # Entries folded out of the log: one segment per log generation
+CHECKPOINT_SEGMENT_SUFFIX = ".msgpack.lz4"  # Each segment is LZ4-compressed msgpack, a header then one entry per object
+CHECKPOINT_THRESHOLD_BYTES = 4 * 1024 * 1024  # Fold the log into the checkpoint once it grows past this
+LEGACY_TIME_ENTRIES_FILE = "time_entries.json"
+PENDING_ENTRIES_FILE = "pending.json"
+SHEET_STATE_FILE = ".sheet_state.json"  # Remembers whether the sheet already has a header row
+SYNC_BATCH_SIZE = 20  # Flush queued entries once this many are waiting
+SYNC_INTERVAL_SECONDS = 300  # ...or once the oldest queued entry is this old
+SYNC_CHECK_SECONDS = 30  # How often the background worker checks whether a flush is due
+WAL_GROUP_COMMIT_SECONDS = 0.005  # How long the log writer waits to group entries into one fsync
+WAL_GROUP_COMMIT_MAX_ENTRIES = 100  # ...or how many entries it groups at most
+WAL_ACK_TIMEOUT_SECONDS = 10  # Give up waiting for the log writer after this long
+SHEETS_APPEND_BATCH_SIZE = 5000  # Rows sent per Google Sheets append request
+SHEETS_NUM_RETRIES = 5  # Retries with exponential backoff on 429/5xx responses
+TOTP_INTERVAL_SECONDS = 30
+TOTP_WINDOW = 1  # Accept codes from this many intervals before/after now for clock drift
+ENTRY_TYPES = {"i": "In", "o": "Out"}  # Single-character type codes stored in entries
+
+def file_stamp(path):
+    """Returns (mtime_ns, size) for a file, or None if it does not exist; used as a cache key."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
 
-def get_google_sheets_service():
-    """Builds the Google Sheets service object using credentials from st.secrets."""
-    SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
-    
-    # Create credentials from the dictionary-like st.secrets object
-    creds = service_account.Credentials.from_service_account_info(
-        st.secrets["google_credentials"], scopes=SCOPES)
-    return build('sheets', 'v4', credentials=creds)
+@st.cache_data(max_entries=1)
+def read_employee_data(path, stamp):
+    """Parses the employee file. The stamp is only part of the cache key, so a write invalidates it."""
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
 
 # Load employee data
 def load_employee_data():
+    stamp = file_stamp(EMPLOYEE_DATA_FILE)
+    if stamp is None:
+        return {}
     try:
-        with open(EMPLOYEE_DATA_FILE, "r") as f:
-            return json.load(f)
+        return read_employee_data(EMPLOYEE_DATA_FILE, stamp)
     except FileNotFoundError:
         return {}
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         st.error(f"Error decoding JSON in '{EMPLOYEE_DATA_FILE}'.")
         return {}
 
 # Save employee data
 def save_employee_data(data):
-    with open(EMPLOYEE_DATA_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+    with open(EMPLOYEE_DATA_FILE, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
     st.session_state["employee_data"] = data
+    st.session_state["totp_keys"] = build_totp_keys(data)
+    st.session_state["emp_display"] = build_employee_display(data)
+
+def build_employee_display(employee_data):
+    """Precomputes the "Name (ID)" label shown for each employee in the check-in selectbox."""
+    return {employee_id: f"{employee['name']} ({employee_id})" for employee_id, employee in employee_data.items()}
+
+@st.cache_data(max_entries=1)
+def qr_png(otp_path):
+    """
+    Renders the otpauth:// URL as a QR code and returns the PNG bytes.
+    Only the latest code is kept, since it embeds the employee's TOTP secret.
+    """
+    img = qrcode.make(otp_path)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+# --- TOTP VERIFICATION ---
+def decode_totp_secret(secret):
+    """Decodes a base32 TOTP secret, tolerating lowercase letters and missing padding."""
+    return base64.b32decode(secret + "=" * (-len(secret) % 8), casefold=True)
+
+def build_totp_keys(employee_data):
+    """Decodes every employee's TOTP secret once so logins can use the raw key bytes."""
+    keys = {}
+    for employee_id, employee in employee_data.items():
+        try:
+            keys[employee_id] = decode_totp_secret(employee["totpSecret"])
+        except (KeyError, ValueError):
+            st.error(f"Invalid TOTP secret for Employee ID {employee_id}.")
+    return keys
+
+def verify_totp(token, key):
+    """Checks a 6-digit TOTP code (RFC 6238, HMAC-SHA1) against the decoded key."""
+    if not key or len(token) != 6 or not token.isdigit():
+        return False
+    expected = int(token)
+    counter = int(time.time()) // TOTP_INTERVAL_SECONDS
+    for step in range(counter - TOTP_WINDOW, counter + TOTP_WINDOW + 1):
+        digest = hmac.new(key, step.to_bytes(8, "big"), hashlib.sha1).digest()
+        offset = digest[-1] & 0x0F
+        code = (int.from_bytes(digest[offset:offset + 4], "big") & 0x7FFFFFFF) % 1000000
+        if code == expected:
+            return True
+    return False
+
+def open_if_exists(path):
+    try:
+        return open(path, "rb")
+    except FileNotFoundError:
+        return None
+
+def checkpoint_segment_path(epoch):
+    return os.path.join(CHECKPOINT_DIR, f"{epoch:010d}{CHECKPOINT_SEGMENT_SUFFIX}")
+
+def list_checkpoint_segments():
+    """Returns the paths of the checkpoint segments, oldest first."""
+    try:
+        names = os.listdir(CHECKPOINT_DIR)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(CHECKPOINT_DIR, name) for name in sorted(names) if name.endswith(CHECKPOINT_SEGMENT_SUFFIX)]
+
+def open_latest_checkpoint_segment():
+    """Opens the newest checkpoint segment for reading, or returns None if there is no checkpoint yet."""
+    segments = list_checkpoint_segments()
+    if not segments:
+        return None
+    return lz4.frame.open(segments[-1], "rb")
+
+def read_wal_epoch(f):
+    """Returns the generation number from the log's header line; logs without one are generation 1."""
+    f.seek(0)
+    try:
+        header = orjson.loads(f.readline())
+    except orjson.JSONDecodeError:
+        return 1
+    return header["epoch"] if isinstance(header, dict) else 1
+
+def iter_wal_records(f):
+    """
+    Yields the decoded, non-blank lines of an open log file, read through mmap.
+    Unreadable lines (e.g. a write torn by a crash) are yielded as None.
+    """
+    # mmap cannot map an empty file
+    if os.fstat(f.fileno()).st_size == 0:
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for line in iter(mm.readline, b""):
+            if not line.strip():
+                continue
+            try:
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError:
+                yield None
 
-# Load time entries
-def load_time_entries():
+def read_checkpoint_header(unpacker):
+    """
+    Returns a segment's header, or an empty header when there is no checkpoint yet.
+    count is the number of entries in this and all earlier segments; walCount is the
+    number in this segment, i.e. folded out of the log generation numbered epoch.
+    """
+    if unpacker is None:
+        return {"epoch": 0, "count": 0, "walCount": 0}
+    return next(unpacker)
+
+def iter_unfolded_wal_records(wal, checkpoint_header):
+    """
+    Yields the log records that are not in the checkpoint yet (None for unreadable lines).
+    A log with the newest segment's epoch was left behind by an interrupted checkpoint and
+    may have been appended to since; only its first walCount entries are in that segment.
+    """
+    wal_epoch = read_wal_epoch(wal)
+    if wal_epoch < checkpoint_header["epoch"]:
+        return
+    folded = checkpoint_header["walCount"] if wal_epoch == checkpoint_header["epoch"] else 0
+    for record in iter_wal_records(wal):
+        if isinstance(record, dict):
+            continue
+        if isinstance(record, list) and folded > 0:
+            folded -= 1
+            continue
+        yield record
+
+def iter_log_entries():
+    """
+    Yields every time entry: the checkpoint segments first, then the log entries not yet folded into them.
+    The log is opened before the segments are listed so a concurrent checkpoint can never hide entries.
+    """
+    wal = open_if_exists(TIME_ENTRIES_FILE)
+    bad_lines = 0
+    try:
+        header = read_checkpoint_header(None)
+        for path in list_checkpoint_segments():
+            with lz4.frame.open(path, "rb") as segment:
+                unpacker = msgpack.Unpacker(segment)
+                header = read_checkpoint_header(unpacker)
+                yield from unpacker
+        if wal:
+            for record in iter_unfolded_wal_records(wal, header):
+                if record is None:
+                    bad_lines += 1
+                else:
+                    yield record
+    finally:
+        if wal:
+            wal.close()
+    if bad_lines:
+        st.error(f"Skipped {bad_lines} unreadable line(s) in '{TIME_ENTRIES_FILE}'.")
+
+@st.cache_data(max_entries=1)
+def read_time_entry_count(wal_stamp, checkpoint_stamp):
+    """
+    Counts the time entries, using the newest segment's header instead of reading the checkpoint.
+    The stamps are only part of the cache key, so any write to the log or the checkpoint invalidates it.
+    """
+    wal = open_if_exists(TIME_ENTRIES_FILE)
+    checkpoint = open_latest_checkpoint_segment()
+    header = read_checkpoint_header(None)
+    if checkpoint:
+        with checkpoint:
+            header = read_checkpoint_header(msgpack.Unpacker(checkpoint))
+    count = header["count"]
+    if wal:
+        with wal:
+            count += sum(1 for record in iter_unfolded_wal_records(wal, header) if record is not None)
+    return count
+
+# Count the time entries, reusing the last count while the files are unchanged
+def count_time_entries():
+    return read_time_entry_count(file_stamp(TIME_ENTRIES_FILE), file_stamp(CHECKPOINT_DIR))
+
+def checkpoint_time_entries():
+    """
+    Folds the log into a new checkpoint segment, then starts the next log generation.
+    Earlier segments are never rewritten, so the cost is proportional to the log, not the history.
+    Only called from the log writer thread, so nothing is appended meanwhile.
+    """
+    wal = open(TIME_ENTRIES_FILE, "rb")
+    checkpoint = open_latest_checkpoint_segment()
+    try:
+        unpacker = msgpack.Unpacker(checkpoint) if checkpoint else None
+        header = read_checkpoint_header(unpacker)
+        wal_epoch = read_wal_epoch(wal)
+        wal_entries = [record for record in iter_unfolded_wal_records(wal, header) if record is not None]
+
+        # A log left behind by an interrupted checkpoint keeps the epoch of the segment it was
+        # folded into; only rewrite that segment if there is something new to add to it
+        if wal_entries or wal_epoch > header["epoch"]:
+            carried = unpacker if wal_epoch == header["epoch"] else ()
+            folded = header["walCount"] if wal_epoch == header["epoch"] else 0
+            os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+            segment_file = checkpoint_segment_path(wal_epoch)
+            tmp_file = segment_file + ".tmp"
+            packer = msgpack.Packer()
+            with open(tmp_file, "wb") as raw:
+                # The frame's content checksum lets readers detect a corrupted segment
+                with lz4.frame.LZ4FrameFile(raw, "wb", content_checksum=True) as f:
+                    f.write(packer.pack({
+                        "epoch": wal_epoch,
+                        "count": header["count"] + len(wal_entries),
+                        "walCount": folded + len(wal_entries),
+                    }))
+                    for entry in itertools.chain(carried, wal_entries):
+                        f.write(packer.pack(entry))
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(tmp_file, segment_file)
+    finally:
+        wal.close()
+        if checkpoint:
+            checkpoint.close()
+
+    # Every entry in the log is now in the checkpoint, so it is safe to start a new one
+    tmp_file = TIME_ENTRIES_FILE + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(orjson.dumps({"epoch": wal_epoch + 1}) + b"\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, TIME_ENTRIES_FILE)
+
+def checkpoint_interrupted():
+    """Returns True if the log still has the epoch of the newest segment, i.e. a checkpoint stopped before rotating it."""
+    wal = open_if_exists(TIME_ENTRIES_FILE)
+    checkpoint = open_latest_checkpoint_segment()
+    if not wal or not checkpoint:
+        for f in (wal, checkpoint):
+            if f:
+                f.close()
+        return False
+    with wal, checkpoint:
+        return read_wal_epoch(wal) <= read_checkpoint_header(msgpack.Unpacker(checkpoint))["epoch"]
+
+def write_time_entries_loop(writer):
+    """
+    Background writer for the time entry log (group commit).
+    Entries arriving within WAL_GROUP_COMMIT_SECONDS of each other are written
+    with a single write and fsync, then every waiting caller is acknowledged.
+    Failures are handed back to the callers (or recorded, for checkpoints) so the
+    thread itself never dies.
+    """
+    entry_queue = writer["queue"]
+    while True:
+        group = [entry_queue.get()]
+        deadline = time.monotonic() + WAL_GROUP_COMMIT_SECONDS
+        while len(group) < WAL_GROUP_COMMIT_MAX_ENTRIES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                group.append(entry_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        # Drop entries whose callers gave up waiting; the rest can no longer be withdrawn
+        with writer["lock"]:
+            group = [(entry, ack) for entry, ack in group if not ack["cancelled"]]
+            for _, ack in group:
+                ack["claimed"] = True
+        if not group:
+            continue
+
+        error = None
+        try:
+            with open(TIME_ENTRIES_FILE, "ab") as f:
+                f.write(b"".join(orjson.dumps(entry) + b"\n" for entry, _ in group))
+                f.flush()
+                os.fsync(f.fileno())
+                wal_size = f.tell()
+        except Exception as e:
+            error = e
+        for _, ack in group:
+            ack["error"] = error
+            ack["done"].set()
+
+        if error is None and wal_size >= CHECKPOINT_THRESHOLD_BYTES:
+            # The log is intact either way; a failed checkpoint is retried after the next write
+            try:
+                checkpoint_time_entries()
+                writer["checkpoint_error"] = None
+            except Exception as e:
+                writer["checkpoint_error"] = e
+
+@st.cache_resource
+def get_time_entry_writer():
+    """Starts the log writer thread once per process and returns its queue, lock, thread and last checkpoint error."""
+    writer = {"queue": queue.Queue(), "lock": threading.Lock(), "checkpoint_error": None}
+    # Finish rotating a log left behind by an interrupted checkpoint before anything is appended to it
+    try:
+        if checkpoint_interrupted():
+            checkpoint_time_entries()
+    except Exception as e:
+        writer["checkpoint_error"] = e
+    writer["thread"] = threading.Thread(target=write_time_entries_loop, args=(writer,), daemon=True)
+    writer["thread"].start()
+    return writer
+
+# Append a single time entry to the log, returning once it has reached the disk
+def append_time_entry(entry):
+    writer = get_time_entry_writer()
+    if not writer["thread"].is_alive():
+        get_time_entry_writer.clear()
+        writer = get_time_entry_writer()
+
+    ack = {"done": threading.Event(), "error": None, "cancelled": False, "claimed": False}
+    writer["queue"].put((entry, ack))
+    if not ack["done"].wait(WAL_ACK_TIMEOUT_SECONDS):
+        # Withdraw the entry if the writer has not picked it up yet; once it has, the
+        # entry is being written, so wait for the outcome instead of reporting a failure
+        with writer["lock"]:
+            ack["cancelled"] = not ack["claimed"]
+        if ack["cancelled"]:
+            raise TimeoutError("Timed out waiting for the log writer; the entry was not written.")
+        ack["done"].wait()
+    if ack["error"]:
+        raise ack["error"]
+
+def compact_entry(entry):
+    """Converts an old {"employeeId", "timestamp", "type"} entry to [employeeId, epoch, type]."""
+    epoch = int(datetime.fromisoformat(entry["timestamp"]).timestamp())
+    return [entry["employeeId"], epoch, entry["type"][0]]
+
+def migrate_legacy_time_entries():
+    """
+    Converts the old JSON array file into the append-only log.
+    The old file is kept as a .bak copy once the log has been written; entries that
+    cannot be converted are skipped with a warning and remain in that copy.
+    """
+    if not os.path.exists(LEGACY_TIME_ENTRIES_FILE) or os.path.exists(TIME_ENTRIES_FILE):
+        return
+    try:
+        with open(LEGACY_TIME_ENTRIES_FILE, "rb") as f:
+            entries = orjson.loads(f.read())
+    except orjson.JSONDecodeError:
+        st.error(f"Error decoding JSON in '{LEGACY_TIME_ENTRIES_FILE}'.")
+        return
+    if not isinstance(entries, list):
+        st.error(f"Expected a list of entries in '{LEGACY_TIME_ENTRIES_FILE}'.")
+        return
+
+    tmp_file = TIME_ENTRIES_FILE + ".tmp"
+    skipped = 0
+    try:
+        with open(tmp_file, "wb") as f:
+            for entry in entries:
+                try:
+                    line = orjson.dumps(compact_entry(entry)) + b"\n"
+                except (KeyError, IndexError, TypeError, ValueError, AttributeError, OverflowError):
+                    skipped += 1
+                    continue
+                f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, TIME_ENTRIES_FILE)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    os.replace(LEGACY_TIME_ENTRIES_FILE, LEGACY_TIME_ENTRIES_FILE + ".bak")
+    if skipped:
+        st.warning(f"Skipped {skipped} malformed entries while converting '{LEGACY_TIME_ENTRIES_FILE}'; they remain in '{LEGACY_TIME_ENTRIES_FILE}.bak'.")
+
+# Load entries waiting to be synced to Google Sheets
+def load_pending_entries():
     try:
-        with open(TIME_ENTRIES_FILE, "r") as f:
-            return json.load(f)
+        with open(PENDING_ENTRIES_FILE, "rb") as f:
+            return orjson.loads(f.read())
     except FileNotFoundError:
         return []
-    except json.JSONDecodeError:
-        st.error(f"Error decoding JSON in '{TIME_ENTRIES_FILE}'.")
+    except orjson.JSONDecodeError:
+        st.error(f"Error decoding JSON in '{PENDING_ENTRIES_FILE}'.")
         return []
 
-# Save time entries
-def save_time_entries(data):
-    with open(TIME_ENTRIES_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+# Save entries waiting to be synced to Google Sheets
+def save_pending_entries(data):
+    # Write a temporary file and swap it in, so a crash never leaves a truncated queue
+    tmp_file = PENDING_ENTRIES_FILE + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(orjson.dumps(data))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, PENDING_ENTRIES_FILE)
+
+@st.cache_resource
+def get_pending_lock():
+    """Process-wide lock around every read-modify-write of pending.json."""
+    return threading.Lock()
+
+@st.cache_resource
+def get_flush_lock():
+    """Process-wide lock so only one flush or full re-sync talks to the sheet at a time."""
+    return threading.Lock()
+
+def queue_pending_entry(entry):
+    """Adds an entry to the queue of entries not yet appended to the sheet."""
+    with get_pending_lock():
+        entries = load_pending_entries()
+        entries.append(entry)
+        save_pending_entries(entries)
+
+def remove_pending_entries(count):
+    """Drops the oldest count entries from the queue once they are in the sheet."""
+    with get_pending_lock():
+        entries = load_pending_entries()
+        save_pending_entries(entries[count:])
+
+def count_pending_entries():
+    with get_pending_lock():
+        return len(load_pending_entries())
+
+# Load what we know about the Google Sheet between runs
+def load_sheet_state():
+    try:
+        with open(SHEET_STATE_FILE, "rb") as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return {}
+    except orjson.JSONDecodeError:
+        st.error(f"Error decoding JSON in '{SHEET_STATE_FILE}'.")
+        return {}
+
+# Save what we know about the Google Sheet between runs
+def save_sheet_state(data):
+    with open(SHEET_STATE_FILE, "wb") as f:
+        f.write(orjson.dumps(data))
 
 # --- GOOGLE SHEETS INTEGRATION ---
+@st.cache_resource
 def get_google_sheets_service():
-    """Builds the Google Sheets service object using credentials from st.secrets."""
+    """
+    Builds the Google Sheets service object using credentials from st.secrets.
+    The service is cached so reruns reuse the same credentials and client. httplib2
+    is not thread-safe, so every request gets its own authorized Http object.
+    """
     SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
     creds = service_account.Credentials.from_service_account_info(
         st.secrets["google_credentials"], scopes=SCOPES)
-    return build('sheets', 'v4', credentials=creds)
 
-def sync_to_google_sheets(time_entries, employee_data):
+    def build_request(http, *args, **kwargs):
+        return googleapiclient.http.HttpRequest(AuthorizedHttp(creds, http=googleapiclient.http.build_http()), *args, **kwargs)
+
+    # Use the discovery document bundled with the client instead of fetching it
+    return build('sheets', 'v4', http=AuthorizedHttp(creds, http=googleapiclient.http.build_http()), requestBuilder=build_request,
+                 static_discovery=True, cache_discovery=False)
+
+@st.cache_resource
+def get_spreadsheet_id():
+    """Returns the configured spreadsheet ID from st.secrets."""
+    return st.secrets["googleSheets"]["spreadsheetId"]
+
+def set_sheet_header_written(written):
+    """Records whether the header row is in the sheet, so later syncs and restarts know it."""
+    save_sheet_state({"headerWritten": written})
+
+def sheet_header_written(service, spreadsheet_id, range_name):
+    """
+    Returns whether the sheet already has a header row.
+    The state file is read on every sync, so a re-sync in another session is seen
+    immediately; the sheet itself is only read when the file does not know.
+    """
+    state = load_sheet_state()
+    if "headerWritten" in state:
+        return state["headerWritten"]
+
+    result = service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=range_name).execute(num_retries=SHEETS_NUM_RETRIES)
+    written = bool(result.get('values'))
+    set_sheet_header_written(written)
+    return written
+
+# Lookup tables for the "%b %d %I:%M %p" sheet timestamp, indexed by month, day of month and minute of day
+MONTH_LABELS = np.array(["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"], dtype=object)
+DAY_LABELS = np.array([f" {day:02d} " for day in range(32)], dtype=object)
+CLOCK_LABELS = np.array(
+    [f"{(minute // 60 + 11) % 12 + 1:02d}:{minute % 60:02d} {'AM' if minute < 720 else 'PM'}" for minute in range(1440)],
+    dtype=object)
+MAX_EPOCH_SECONDS = 253402300799  # 9999-12-31 23:59:59 UTC
+
+def format_epochs(epochs):
     """
-    Attempts to sync a list of time entries to Google Sheets.
-    This version reads configuration from st.secrets.
+    Formats epoch seconds as local-time "%b %d %I:%M %p" strings without strftime.
+    UTC offsets are looked up once per distinct minute, which is exact for every offset
+    change that falls on a minute boundary (all of them since 1972); the rest is array
+    arithmetic and table lookups.
     """
+    epochs = np.asarray(epochs, dtype=np.int64)
+    minutes, minute_index = np.unique(epochs // 60, return_inverse=True)
+    offsets = np.array([time.localtime(int(minute) * 60).tm_gmtoff for minute in minutes], dtype=np.int64)
+    local_minutes = (epochs + offsets[minute_index]).astype("datetime64[s]").astype("datetime64[m]")
+
+    months = local_minutes.astype("datetime64[M]")
+    days = local_minutes.astype("datetime64[D]")
+    month_of_year = months.astype(np.int64) % 12
+    day_of_month = (days - months.astype("datetime64[D]")).astype(np.int64) + 1
+    minute_of_day = (local_minutes - days.astype("datetime64[m]")).astype(np.int64)
+    return MONTH_LABELS[month_of_year] + DAY_LABELS[day_of_month] + CLOCK_LABELS[minute_of_day]
+
+def format_sheet_rows(time_entries, names, warn=st.warning):
+    """
+    Turns compact time entries into [Employee ID, Employee Name, Timestamp, Type] rows.
+    The entries are formatted column-wise with pandas rather than row by row.
+    """
+    df = pd.DataFrame(time_entries, columns=["employeeId", "epoch", "type"])
+    epochs = pd.to_numeric(df["epoch"], errors="coerce")
+    valid_epochs = epochs.between(0, MAX_EPOCH_SECONDS)
+    df["timestamp"] = None
+    df.loc[valid_epochs, "timestamp"] = format_epochs(epochs[valid_epochs].to_numpy())
+    df["typeLabel"] = df["type"].map(ENTRY_TYPES)
+    df["name"] = df["employeeId"].map(names).fillna("Unknown")
+
+    invalid = df["timestamp"].isna() | df["typeLabel"].isna()
+    if invalid.any():
+        invalid_ids = ", ".join(sorted(set(df.loc[invalid, "employeeId"].astype(str))))
+        warn(f"Could not format {invalid.sum()} entries for Employee ID(s) {invalid_ids}. Syncing raw data for these rows.")
+        df.loc[invalid, "timestamp"] = df.loc[invalid, "epoch"].map(str)
+        df.loc[invalid, "typeLabel"] = df.loc[invalid, "type"].map(str)
+
+    return df[["employeeId", "name", "timestamp", "typeLabel"]].values.tolist()
+
+def sync_to_google_sheets(time_entries, employee_data, warn=st.warning):
+    """
+    Attempts to sync an iterable of time entries to Google Sheets.
+    Entries are appended in batches of SHEETS_APPEND_BATCH_SIZE rows so large
+    logs never have to be held in memory or sent in a single request.
+    """
+    entry_count = 0
     try:
         service = get_google_sheets_service()
-        spreadsheet_id = st.secrets["googleSheets"]["spreadsheetId"]
+        spreadsheet_id = get_spreadsheet_id()
         range_name = "Sheet1"
 
-        result = service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=range_name).execute()
-        is_empty = not result.get('values')
-
-        values_to_send = []
-        if is_empty:
-            values_to_send.append(["Employee ID", "Employee Name", "Timestamp", "Type"])
-
-        for entry in time_entries:
-            try:
-                ts_object = datetime.fromisoformat(entry["timestamp"])
-                friendly_ts = ts_object.strftime("%b %d %I:%M %p")
-                capitalized_type = entry["type"].capitalize()
-            except (ValueError, TypeError) as e:
-                st.warning(f"Could not format entry for Employee ID {entry.get('employeeId', 'N/A')}. Error: {e}. Syncing raw data for this row.")
-                friendly_ts = entry.get("timestamp", "INVALID_TIMESTAMP")
-                capitalized_type = entry.get("type", "N/A")
-
-            row = [
-                entry["employeeId"],
-                employee_data.get(entry["employeeId"], {}).get("name", "Unknown"),
-                friendly_ts,
-                capitalized_type
-            ]
-            values_to_send.append(row)
-
-        if len(values_to_send) == (1 if is_empty else 0):
+        header_written = sheet_header_written(service, spreadsheet_id, range_name)
+
+        # Flatten the employee lookup once for the whole sync rather than per batch
+        names = {employee_id: employee.get("name", "Unknown") for employee_id, employee in employee_data.items()}
+        entries = iter(time_entries)
+        while True:
+            chunk = list(itertools.islice(entries, SHEETS_APPEND_BATCH_SIZE))
+            if not chunk:
+                break
+
+            values_to_send = format_sheet_rows(chunk, names, warn)
+            if not header_written:
+                values_to_send.insert(0, ["Employee ID", "Employee Name", "Timestamp", "Type"])
+
+            # execute() retries 429 and 5xx responses with exponential backoff
+            service.spreadsheets().values().append(
+                spreadsheetId=spreadsheet_id,
+                range=range_name,
+                valueInputOption="USER_ENTERED",
+                body={"values": values_to_send}
+            ).execute(num_retries=SHEETS_NUM_RETRIES)
+            if not header_written:
+                set_sheet_header_written(True)
+                header_written = True
+            entry_count += len(chunk)
+
+        if not entry_count:
              return True, "No new entries to sync."
 
-        body = {"values": values_to_send}
-
-        service.spreadsheets().values().append(
-            spreadsheetId=spreadsheet_id,
-            range=range_name,
-            valueInputOption="USER_ENTERED",
-            body=body
-        ).execute()
-
-        return True, f"Synced {len(time_entries)} entries to Google Sheets."
+        return True, f"Synced {entry_count} entries to Google Sheets."
 
     except Exception as e:
+        if entry_count:
+            return False, f"Error syncing to Google Sheets after {entry_count} entries were synced: {e}"
         return False, f"Error syncing to Google Sheets: {e}"
 
-def handle_entry(employee_id, entry_type, employee_data):
+def flush_pending_entries(employee_data, warn=st.warning):
+    """
+    Sends all queued entries to Google Sheets and removes them from the queue once
+    the append has succeeded. Entries queued while the sync runs stay queued.
+    """
+    flush_lock = get_flush_lock()
+    if not flush_lock.acquire(blocking=False):
+        return True, "Another sync is already running; queued entries will go with it or the next batch."
+    try:
+        with get_pending_lock():
+            entries = load_pending_entries()
+        if not entries:
+            return True, "No pending entries to sync."
+
+        success, message = sync_to_google_sheets(entries, employee_data, warn)
+        if success:
+            remove_pending_entries(len(entries))
+        return success, message
+    finally:
+        flush_lock.release()
+
+def pending_flush_due():
+    """Returns True when the queue is large enough or old enough to be flushed."""
+    with get_pending_lock():
+        entries = load_pending_entries()
+    if not entries:
+        return False
+    if len(entries) >= SYNC_BATCH_SIZE:
+        return True
+    return time.time() - entries[0][1] >= SYNC_INTERVAL_SECONDS
+
+@st.cache_resource
+def get_sync_wake_event():
+    """Process-wide event that wakes the background sync as soon as a batch is due."""
+    return threading.Event()
+
+def sync_pending_loop():
+    """Flushes the queue once it is due, even when no new check-in arrives to trigger it."""
+    wake = get_sync_wake_event()
+    while True:
+        wake.wait(SYNC_CHECK_SECONDS)
+        wake.clear()
+        try:
+            if not pending_flush_due():
+                continue
+            stamp = file_stamp(EMPLOYEE_DATA_FILE)
+            employee_data = read_employee_data(EMPLOYEE_DATA_FILE, stamp) if stamp else {}
+            success, message = flush_pending_entries(employee_data, warn=logger.warning)
+            if not success:
+                logger.warning(message)
+        except Exception:
+            logger.exception("Background sync of pending entries failed.")
+
+@st.cache_resource
+def start_pending_sync_worker():
+    """Starts the background sync thread once per process."""
+    thread = threading.Thread(target=sync_pending_loop, daemon=True)
+    thread.start()
+    return thread
+
+def handle_entry(employee_id, entry_type):
     """
-    Handles a new time entry by saving it locally first, then attempting to sync.
+    Handles a new time entry by saving it locally and queueing it for a batched sync.
     """
-    # Create the new entry dictionary
-    timestamp = datetime.now().isoformat()
-    entry = {"employeeId": employee_id, "timestamp": timestamp, "type": entry_type}
+    # Create the new entry as [employeeId, epoch seconds, "i"/"o"]
+    entry = [employee_id, int(time.time()), entry_type[0]]
 
     # Always save the new entry to the local log first
-    time_entries = load_time_entries()
-    time_entries.append(entry)
-    save_time_entries(time_entries)
-
-    # Attempt to sync just the new entry to Google Sheets
-    success, message = sync_to_google_sheets([entry], employee_data)
+    try:
+        append_time_entry(entry)
+    except Exception as e:
+        st.error(f"Check-in/out could not be saved: {e}")
+        return
 
-    # Report the result to the user
-    if success:
-        st.success("Check-in/out recorded and synced to Google Sheets.")
-    else:
-        st.warning("Check-in/out has been recorded locally, but the online sync failed.")
-        st.error(message)
+    # Queue the entry; the background worker contacts Google Sheets once a batch is due
+    queue_pending_entry(entry)
+    if pending_flush_due():
+        get_sync_wake_event().set()
+    st.success("Check-in/out recorded. It will be synced to Google Sheets with the next batch.")
 
 # --- OFFLINE FALLBACK ---
 def handle_offline_entry(employee_id, timestamp, entry_type):
-    time_entries = load_time_entries()
-    time_entries.append({"employeeId": employee_id, "timestamp": timestamp, "type": entry_type})
-    save_time_entries(time_entries)
+    entry = [employee_id, int(datetime.fromisoformat(timestamp).timestamp()), entry_type[0]]
+    try:
+        append_time_entry(entry)
+    except Exception as e:
+        st.error(f"Entry could not be saved: {e}")
+        return
+    queue_pending_entry(entry)
+    if pending_flush_due():
+        get_sync_wake_event().set()
     st.success("Entry saved locally. Will sync when online.")
 
 # --- MAIN APP ---
 def main():
     st.title("Employee Check-in System")
+    migrate_legacy_time_entries()
+    start_pending_sync_worker()
 
     # Load employee data from JSON into the session state if it's not already there
     if "employee_data" not in st.session_state:
         st.session_state["employee_data"] = load_employee_data()
+        st.session_state["totp_keys"] = build_totp_keys(st.session_state["employee_data"])
+        st.session_state["emp_display"] = build_employee_display(st.session_state["employee_data"])
     
     # Create a reference to the employee data for easier access
     employee_data = st.session_state["employee_data"]
+    totp_keys = st.session_state["totp_keys"]
 
     # --- SIDEBAR & ADMIN ACCESS ---
     st.sidebar.title("Admin Control Panel")
@@ -180,8 +777,8 @@ def main():
 
             if st.button("Generate TOTP Secret"):
                 if employee_id and employee_name:
-                    secret_bytes = secrets.token_bytes(20)
-                    secret = base64.b32encode(secret_bytes).decode('utf-8')
+                    # 20 random bytes encode to 32 base32 characters, which are URL-safe and need no padding
+                    secret = base64.b32encode(secrets.token_bytes(20)).rstrip(b"=").decode("ascii")
                     st.session_state.new_employee_secret = secret
                 else:
                     st.warning("Please enter an Employee ID and Name before generating a secret.")
@@ -190,11 +787,7 @@ def main():
                 secret = st.session_state.new_employee_secret
                 employee_id_encoded = urllib.parse.quote(employee_id)
                 otp_path = f"otpauth://totp/EmployeeCheckin:{employee_id_encoded}?secret={secret}&issuer=EmployeeCheckin"
-                img = qrcode.make(otp_path)
-                
-                buf = io.BytesIO()
-                img.save(buf, format="PNG")
-                st.image(buf.getvalue(), caption="Scan this QR code with your authenticator app")
+                st.image(qr_png(otp_path), caption="Scan this QR code with your authenticator app")
                 st.code(f"Secret: {secret}")
 
                 if st.button("Save Employee"):
@@ -217,7 +810,7 @@ def main():
             employee_id = st.selectbox("Select Employee", list(employee_data.keys()), format_func=lambda x: f"{x} - {employee_data[x]['name']}")
             entry_type = st.selectbox("Entry Type", ["in", "out"])
             if st.button("Add Manual Entry"):
-                handle_entry(employee_id, entry_type, employee_data)
+                handle_entry(employee_id, entry_type)
             st.sidebar.button("Log Out of Admin", on_click=clear_admin_password)
 
         # --- ADMIN PAGE: VIEW CONFLICTS ---
@@ -228,46 +821,101 @@ def main():
 
         # --- ADMIN PAGE: SYNC TO GOOGLE SHEETS ---
         elif admin_page == "Sync to Google Sheets":
+            st.subheader("Sync Pending Entries")
+            pending_count = count_pending_entries()
+            if not pending_count:
+                st.info("There are no entries waiting to be synced.")
+            elif st.button(f"Flush {pending_count} Pending Entries"):
+                success, message = flush_pending_entries(employee_data)
+                if success:
+                    st.success(message)
+                else:
+                    st.error(message)
+
+            checkpoint_error = get_time_entry_writer()["checkpoint_error"]
+            if checkpoint_error:
+                st.error(f"Folding the time entry log into '{CHECKPOINT_DIR}' failed and will be retried: {checkpoint_error}")
+
             st.subheader("Full Re-Sync to Google Sheets")
             st.warning("This action will clear all data in the Google Sheet and replace it with the complete log from the local file. Use this for recovery if the sheet becomes out of sync.")
             
-            time_entries = load_time_entries()
-            if not time_entries:
+            entry_count = count_time_entries()
+            if not entry_count:
                 st.info("The local entry log is empty.")
             else:
-                if st.button(f"Clear Sheet and Sync All {len(time_entries)} Entries"):
+                if st.button(f"Clear Sheet and Sync All {entry_count} Entries"):
+                    # Wait for any running flush, and keep new ones out until the re-sync is done
+                    flush_lock = get_flush_lock()
+                    flush_lock.acquire()
                     try:
+                        # Entries queued from here on may also be in the log read below; a duplicate
+                        # row in the sheet is preferable to a missing one, so they stay queued
+                        queued_count = count_pending_entries()
                         service = get_google_sheets_service()
-                        spreadsheet_id = st.secrets["googleSheets"]["spreadsheetId"]
+                        spreadsheet_id = get_spreadsheet_id()
                         
-                        service.spreadsheets().values().clear(spreadsheetId=spreadsheet_id, range="Sheet1").execute()
+                        service.spreadsheets().values().clear(spreadsheetId=spreadsheet_id, range="Sheet1").execute(num_retries=SHEETS_NUM_RETRIES)
+                        set_sheet_header_written(False)
                         
-                        success, message = sync_to_google_sheets(time_entries, employee_data)
+                        success, message = sync_to_google_sheets(iter_log_entries(), employee_data)
                         
                         if success:
+                            # The full log now includes everything that was queued before the re-sync
+                            remove_pending_entries(queued_count)
                             st.success("Successfully cleared the sheet and performed a full re-sync.")
                         else:
                             st.error(f"Full re-sync failed: {message}")
                     except Exception as e:
                         st.error(f"An error occurred during the full sync process: {e}")
+                    finally:
+                        flush_lock.release()
             st.sidebar.button("Log Out of Admin", on_click=clear_admin_password)
 
         # --- ADMIN PAGE: MANAGE EMPLOYEES ---
         elif admin_page == "Manage Employees":
             st.subheader("Manage Existing Employees")
-            for employee_id in list(employee_data.keys()):
-                with st.expander(f"{employee_id} - {employee_data[employee_id]['name']}"):
-                    new_name = st.text_input("Update Name", value=employee_data[employee_id]['name'], key=f"name_{employee_id}")
-                    if st.button("Update Name", key=f"update_{employee_id}"):
-                        employee_data[employee_id]['name'] = new_name
-                        save_employee_data(employee_data)
-                        st.success(f"Name updated for {employee_id}.")
-                        st.rerun()
-                    if st.button("Delete Employee", type="primary", key=f"delete_{employee_id}"):
+
+            # Edits are collected here (employee ID -> new name, or None to delete) and saved together
+            if "emp_pending" not in st.session_state:
+                st.session_state["emp_pending"] = {}
+            emp_pending = st.session_state["emp_pending"]
+
+            def queue_rename(employee_id):
+                emp_pending[employee_id] = st.session_state[f"name_{employee_id}"]
+
+            def queue_delete(employee_id):
+                emp_pending[employee_id] = None
+
+            def discard_change(employee_id):
+                emp_pending.pop(employee_id, None)
+
+            def apply_changes():
+                for employee_id, new_name in emp_pending.items():
+                    if employee_id not in employee_data:
+                        continue
+                    if new_name is None:
                         del employee_data[employee_id]
-                        save_employee_data(employee_data)
-                        st.success(f"Employee {employee_id} has been deleted.")
-                        st.rerun()
+                    else:
+                        employee_data[employee_id]['name'] = new_name
+                save_employee_data(employee_data)
+                st.success(f"Saved {len(emp_pending)} change(s).")
+                emp_pending.clear()
+
+            for employee_id in list(employee_data.keys()):
+                label = f"{employee_id} - {employee_data[employee_id]['name']}"
+                if employee_id in emp_pending:
+                    pending_name = emp_pending[employee_id]
+                    label += " (pending delete)" if pending_name is None else f" (pending rename to {pending_name})"
+                with st.expander(label):
+                    st.text_input("Update Name", value=employee_data[employee_id]['name'], key=f"name_{employee_id}")
+                    st.button("Update Name", key=f"update_{employee_id}", on_click=queue_rename, args=(employee_id,))
+                    st.button("Delete Employee", type="primary", key=f"delete_{employee_id}", on_click=queue_delete, args=(employee_id,))
+                    if employee_id in emp_pending:
+                        st.button("Discard Change", key=f"discard_{employee_id}", on_click=discard_change, args=(employee_id,))
+
+            if emp_pending:
+                st.info(f"{len(emp_pending)} change(s) waiting to be saved.")
+                st.button("Apply Changes", type="primary", on_click=apply_changes)
             st.sidebar.button("Log Out of Admin", on_click=clear_admin_password)
 
     # --- REGULAR USER VIEW (NOT ADMIN) ---
@@ -277,24 +925,25 @@ def main():
         if not employee_data:
             st.info("No employees found. Please contact an administrator to add employees to the system.")
         else:
+            emp_display = st.session_state["emp_display"]
             employee_id = st.selectbox(
                 "Select Your Name",
-                options=list(employee_data.keys()),
-                format_func=lambda x: f"{employee_data[x]['name']} ({x})" if x in employee_data else ""
+                options=list(emp_display),
+                format_func=emp_display.get
             )
             totp_token = st.text_input("Enter 6-Digit Code from Authenticator App", max_chars=6)
 
             col1, col2 = st.columns(2)
             with col1:
                 if st.button("Check In", type="primary", use_container_width=True):
-                    if totp_token and onetimepass.valid_totp(totp_token, employee_data[employee_id]["totpSecret"]):
-                        handle_entry(employee_id, "in", employee_data)
+                    if totp_token and verify_totp(totp_token, totp_keys.get(employee_id)):
+                        handle_entry(employee_id, "in")
                     else:
                         st.error("Invalid or empty code.")
             with col2:
                 if st.button("Check Out", use_container_width=True):
-                    if totp_token and onetimepass.valid_totp(totp_token, employee_data[employee_id]["totpSecret"]):
-                        handle_entry(employee_id, "out", employee_data)
+                    if totp_token and verify_totp(totp_token, totp_keys.get(employee_id)):
+                        handle_entry(employee_id, "out")
                     else:
                         st.error("Invalid or empty code.")
 